@@ -1,18 +1,48 @@
 # 为了让API路由的逻辑保持干净，我们将所有直接与数据库交互的函数都封装起来。这是一种很好的实践，称为“仓储模式”(Repository Pattern)。
-from sqlalchemy.orm import Session
-from . import models, schemas, security
+from sqlalchemy import select, insert, update, bindparam, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from . import models, schemas
+
+# --- 预构建的查询语句 ---
+# 这些语句在模块导入时只构建一次，每次请求只需绑定参数，省去重复构建 Query 对象的开销。
+# username / email 两列在 models.py 中都带有 unique 索引。
+_GET_USER_BY_USERNAME = select(models.User).where(models.User.username == bindparam("u"))
+_GET_USER_BY_EMAIL = select(models.User).where(models.User.email == bindparam("e"))
+# 冲突判断交给数据库完成：比较结果使用列本身的排序规则 (MySQL 默认不区分大小写)，
+# 与唯一索引的判断方式一致，避免在 Python 里用区分大小写的 == 重新比较而漏判。
+_GET_USER_CONFLICTS = select(
+    (models.User.username == bindparam("u")).label("username_taken"),
+    (models.User.email == bindparam("e")).label("email_taken"),
+).where(
+    or_(models.User.username == bindparam("u"), models.User.email == bindparam("e"))
+)
 
 # --- User CRUD ---
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    return (await db.execute(_GET_USER_BY_EMAIL, {"e": email})).scalar_one_or_none()
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    return (await db.execute(_GET_USER_BY_USERNAME, {"u": username})).scalar_one_or_none()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    # 1. 对明文密码进行哈希
-    hashed_password = security.get_password_hash(user.password)
+async def get_user_conflicts(db: AsyncSession, username: str, email: str) -> set[str]:
+    """
+    一次查询同时检查用户名和邮箱是否已被占用。
+    返回发生冲突的字段集合，可能包含 "username" 和/或 "email"。
+    """
+    conflicts = set()
+    result = await db.execute(_GET_USER_CONFLICTS, {"u": username, "e": email})
+    for row in result:
+        if row.username_taken:
+            conflicts.add("username")
+        if row.email_taken:
+            conflicts.add("email")
+    return conflicts
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate, hashed_password: str):
+    # 1. 密码哈希由调用方在线程池中预先计算好 (Argon2 较慢，不应阻塞事件循环)
     
     # 2. 创建一个SQLAlchemy User模型实例
     db_user = models.User(
@@ -24,63 +54,112 @@ def create_user(db: Session, user: schemas.UserCreate):
     # 3. 将实例添加到数据库会话中
     db.add(db_user)
     # 4. 提交会话，将更改写入数据库
-    db.commit()
-    # 5. 刷新实例，以获取数据库生成的新数据（如ID）
-    db.refresh(db_user)
+    #    ID 由插入结果直接回填，created_at 在 Python 端生成，所以不需要再 refresh
+    #    如果违反唯一索引 (例如两个注册请求同时提交了相同的用户名)，回滚后把 IntegrityError 抛给路由层处理
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
     
     return db_user
 
-def create_user_diagram(db: Session, diagram: schemas.DiagramCreate, user_id: int):
+async def create_user_diagram(db: AsyncSession, diagram: schemas.DiagramCreate, user_id: int):
     """
     为指定用户创建一个新的流程图。
+    直接执行一条 INSERT 语句，不构建 ORM 对象；返回值是可直接作为响应的字典。
+    MySQL 不支持 INSERT ... RETURNING，新记录的 id 取自驱动返回的 lastrowid，
+    时间戳在 Python 端生成，因此整个创建过程只有一次数据库往返。
+    models.utc_now() 生成的是整秒 UTC 时间，与之后 GET 读出的值一致，返回的字典可以直接作为响应。
     """
-    # 创建一个SQLAlchemy Diagram模型实例
-    db_diagram = models.Diagram(
+    now = models.utc_now()
+    values = {
         **diagram.model_dump(),  # 将Pydantic模型转为字典
-        user_id=user_id
-    )
+        "user_id": user_id,
+        "created_at": now,
+        "updated_at": now,
+    }
     
-    db.add(db_diagram)
-    db.commit()
-    db.refresh(db_diagram)
-    return db_diagram
+    result = await db.execute(insert(models.Diagram).values(**values))
+    await db.commit()
+    return {"id": result.inserted_primary_key[0], **values}
 
-def get_user_diagrams(db: Session, user_id: int, skip: int = 0, limit: int = 100):
+async def get_user_diagrams(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
     """
-    根据用户ID获取其所有的流程图，支持分页。
+    根据用户ID获取其所有的流程图，按 id 升序分页。
+    - 传入 after_id 时使用键集分页 (keyset)：直接从 id > after_id 处开始读取，
+      配合 (user_id, id) 复合索引，无论翻到第几页都只扫描 limit 行。
+    - 否则退回到 OFFSET 分页 (skip)，页数越深越慢，仅为兼容旧的调用方式保留。
+    列表页只查询摘要字段，不读取可能很大的 content JSON 字段；
+    只查列、不加载 ORM 对象，也就不存在关系属性懒加载导致的 N+1 问题。
+    完整内容请通过 get_owned_diagram 获取。
     """
-    return db.query(models.Diagram).filter(models.Diagram.user_id == user_id).offset(skip).limit(limit).all()
+    stmt = (
+        select(
+            models.Diagram.id,
+            models.Diagram.title,
+            models.Diagram.created_at,
+            models.Diagram.updated_at,
+        )
+        .where(models.Diagram.user_id == user_id)
+        .order_by(models.Diagram.id)
+        .limit(limit)
+    )
+    if after_id is not None:
+        stmt = stmt.where(models.Diagram.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    return (await db.execute(stmt)).all()
 
-def get_diagram(db: Session, diagram_id: int):
+async def get_owned_diagram(db: AsyncSession, diagram_id: int, user_id: int):
     """
-    根据ID获取单个流程图。
+    获取属于指定用户的单个流程图。
+    所有权校验直接放在 WHERE 条件里 (走 (user_id, id) 索引)，
+    图不存在或不属于该用户时都返回 None，不会把别人的 content 读出来。
     """
-    return db.query(models.Diagram).filter(models.Diagram.id == diagram_id).first()
+    stmt = select(models.Diagram).where(
+        models.Diagram.id == diagram_id,
+        models.Diagram.user_id == user_id,
+    )
+    return (await db.execute(stmt)).scalar_one_or_none()
 
-def update_diagram(db: Session, db_diagram: models.Diagram, diagram_update: schemas.DiagramUpdate):
+async def update_diagram(db: AsyncSession, db_diagram: models.Diagram, diagram_update: schemas.DiagramUpdate):
     """
     更新指定的流程图。
+    直接发送一条 UPDATE 语句，不经过 ORM 的脏数据追踪，也不在提交后 refresh；
+    返回值是把更新内容合并到已加载数据上得到的字典，供路由层作为响应返回。
     """
     # 1. 获取 Pydantic 模型中的数据，并转为字典
     update_data = diagram_update.model_dump(exclude_unset=True)
+    # 显式写入更新时间 (代替 ON UPDATE CURRENT_TIMESTAMP)，这样无需再查一次数据库就能知道新的 updated_at。
+    # utc_now() 返回整秒的 UTC 时间，会话时区也固定为 UTC，所以与数据库自动生成的值、
+    # 以及之后 GET 读出的值完全一致。
+    update_data["updated_at"] = models.utc_now()
+    
+    # 2. 执行单条 UPDATE
+    stmt = (
+        update(models.Diagram)
+        .where(models.Diagram.id == db_diagram.id)
+        .values(**update_data)
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(stmt)
+    
+    # 3. 把已加载的数据和更新内容合并成响应
+    updated = {column.key: getattr(db_diagram, column.key) for column in models.Diagram.__table__.columns}
+    updated.update(update_data)
     
-    # 2. 遍历字典，更新 SQLAlchemy 模型对象的属性
-    for key, value in update_data.items():
-        setattr(db_diagram, key, value)
-        
-    # 3. 提交更改
-    db.add(db_diagram)
-    db.commit()
-    db.refresh(db_diagram)
-    return db_diagram
+    # 4. 提交更改
+    await db.commit()
+    return updated
 
 
 # --- NEW: Delete Diagram Function ---
 
-def delete_diagram(db: Session, db_diagram: models.Diagram):
+async def delete_diagram(db: AsyncSession, db_diagram: models.Diagram):
     """
     删除指定的流程图。
     """
-    db.delete(db_diagram)
-    db.commit()
+    await db.delete(db_diagram)
+    await db.commit()
     # 删除后，我们通常不返回任何东西，所以在路由层直接返回一个成功状态即可
@@ -1,71 +1,132 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 # ‼️ 导入 FastAPI 的请求验证错误类
 from fastapi.exceptions import RequestValidationError
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.openapi.utils import get_openapi
+from typing import Optional
+from contextlib import asynccontextmanager
+import json
+import os
+import threading
+from starlette.concurrency import run_in_threadpool
 
 # 导入项目中的模块
 from . import models, schemas, crud, security
 from .database import engine
 
-# 创建数据库表
-models.Base.metadata.create_all(bind=engine)
+# 是否在启动时自动建表，生产环境请手动维护表结构 (见 readme 的“数据库结构变更”)
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES") == "1"
+
+
+# --- 应用生命周期 ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 创建数据库表 (异步引擎需要通过 run_sync 调用 create_all)
+    # 只在设置了 AUTO_CREATE_TABLES=1 时执行 (如本地开发首次启动)，
+    # 避免多 worker 部署时每个进程启动都去检查一遍表结构
+    if AUTO_CREATE_TABLES:
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+    # 预先生成 OpenAPI schema，避免第一个访问 /docs 的请求承担这部分开销
+    app.openapi()
+    yield
+    # 关闭时释放连接池中的所有连接
+    await engine.dispose()
+
+
+# --- 响应序列化 ---
+# 默认使用 orjson (C 扩展) 序列化响应，流程图的 content 可能很大，比标准库 json 快得多。
+# 但 content 是用户提交的任意 JSON，orjson 无法序列化超过 64 位的整数 (会抛出 TypeError)，
+# 这种情况下退回到标准库 json，保证这类流程图依然可以正常创建和读取。
+class FallbackORJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        try:
+            return super().render(content)
+        except TypeError:
+            # 与 starlette 的 JSONResponse.render 保持一致的输出格式
+            return json.dumps(
+                content,
+                ensure_ascii=False,
+                allow_nan=False,
+                indent=None,
+                separators=(",", ":"),
+            ).encode("utf-8")
+
 
 # 创建FastAPI应用实例
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=FallbackORJSONResponse)
 
 # --- ‼️ NEW: 自定义异常处理器 ---
+# 错误类型 -> 友好提示模板，在模块加载时构建一次，处理请求时只需查表和 format
+_STRING_ERROR_TEMPLATE = "字段 '{field}' 必须是有效的字符串 (Must be a valid string)。"
+_ERR_TEMPLATES = {
+    "missing": "字段 '{field}' 是必需的 (Field is required)。",
+    # 这种通常是 pydantic 自定义校验的错误，msg 已经足够清晰
+    "value_error": "字段 '{field}' 的值无效: {msg}",
+    # pydantic 中所有与字符串相关的错误类型
+    "string_type": _STRING_ERROR_TEMPLATE,
+    "string_sub_type": _STRING_ERROR_TEMPLATE,
+    "string_unicode": _STRING_ERROR_TEMPLATE,
+    "string_too_short": _STRING_ERROR_TEMPLATE,
+    "string_too_long": _STRING_ERROR_TEMPLATE,
+    "string_pattern_mismatch": _STRING_ERROR_TEMPLATE,
+}
+# 对于其他未知错误，保留原始消息
+_DEFAULT_ERR_TEMPLATE = "字段 '{field}' 发生错误: {msg}"
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     """
     捕获并自定义处理 Pydantic 的请求体验证错误。
     """
-    error_messages = []
+    errors = exc.errors()
     
     # ‼️ 检查是否是 JSON decode error
     # 这种错误的 errors() 列表通常只有一个元素
-    if len(exc.errors()) == 1 and exc.errors()[0]['type'] == 'json_invalid':
-        return JSONResponse(
+    if len(errors) == 1 and errors[0]['type'] == 'json_invalid':
+        return FallbackORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST, # 对于无效JSON，400更合适
             content={
                 "detail": "无效的JSON格式 (Invalid JSON format)",
-                "error_detail": exc.errors()[0]['msg'] # 直接使用原始的解码错误信息
+                "error_detail": errors[0]['msg'] # 直接使用原始的解码错误信息
             },
         )
-    for error in exc.errors():
+    
+    error_messages = []
+    for error in errors:
         # 'loc' 是一个元组，例如 ('body', 'username')
         # 我们把它转换成 'body.username' 的形式
-        field_path = ".".join(str(loc_item) for loc_item in error['loc'])
+        field_path = ".".join(map(str, error['loc']))
         
-        error_type = error['type']
-        msg = error['msg']
-        
-        # 根据不同的错误类型，生成更友好的消息
-        if error_type == 'missing':
-            message = f"字段 '{field_path}' 是必需的 (Field is required)。"
-        elif 'string' in error_type:
-            message = f"字段 '{field_path}' 必须是有效的字符串 (Must be a valid string)。"
-        elif error_type == 'value_error':
-            # 这种通常是 pydantic 自定义校验的错误，msg 已经足够清晰
-            message = f"字段 '{field_path}' 的值无效: {msg}"
-        else:
-            # 对于其他未知错误，保留原始消息
-            message = f"字段 '{field_path}' 发生错误: {msg}"
+        # 根据不同的错误类型，查表生成更友好的消息
+        template = _ERR_TEMPLATES.get(error['type'], _DEFAULT_ERR_TEMPLATE)
+        message = template.format(field=field_path, msg=error['msg'])
             
         error_messages.append({"error_field": field_path, "error_detail": message})
 
-    return JSONResponse(
+    return FallbackORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={"detail": "请求体验证失败 (Request body validation failed)", "errors": error_messages},
     )
 
 # --- 终极自定义OpenAPI Schema ---
+# 生成 schema 需要遍历所有路由和模型，开销较大；加锁保证并发请求时只会生成一次
+_openapi_lock = threading.Lock()
+
 def custom_openapi():
     if app.openapi_schema:
         return app.openapi_schema
-    
+    with _openapi_lock:
+        # 拿到锁之后再检查一次，可能已经被其他线程生成好了
+        if app.openapi_schema:
+            return app.openapi_schema
+        app.openapi_schema = _build_openapi_schema()
+    return app.openapi_schema
+
+def _build_openapi_schema():
     # 1. 获取默认的schema
     openapi_schema = get_openapi(
         title="在线流程图 API",
@@ -88,69 +149,91 @@ def custom_openapi():
         "description": "输入你的 Bearer Token. 格式: 'Bearer &lt;token&gt;（只粘贴 token 本身）'"
     }
             
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
+    return openapi_schema
 
 # 4. 应用这个自定义函数
 app.openapi = custom_openapi
 
 # --- 根路由 ---
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "你好，欢迎来到在线流程图API！"}
 
 # --- 认证路由 ---
 
+# 注意：数据库访问使用异步会话直接 await；Argon2 哈希/校验是 CPU/内存密集型的同步操作，
+# 需要通过 run_in_threadpool 放到线程池中执行，避免阻塞事件循环。
+
 @app.post("/auth/register", response_model=schemas.UserOut)
-def register_user(user: schemas.UserCreate, db: Session = Depends(security.get_db)):
-    db_user_by_username = crud.get_user_by_username(db, username=user.username)
-    if db_user_by_username:
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(security.get_db)):
+    # 一次查询同时检查用户名和邮箱是否已被占用
+    conflicts = await crud.get_user_conflicts(db, username=user.username, email=user.email)
+    if "username" in conflicts:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用户名已被注册")
-
-    db_user_by_email = crud.get_user_by_email(db, email=user.email)
-    if db_user_by_email:
+    if "email" in conflicts:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="邮箱已被注册")
 
-    new_user = crud.create_user(db=db, user=user)
+    hashed_password = await run_in_threadpool(security.get_password_hash, user.password)
+    try:
+        new_user = await crud.create_user(db=db, user=user, hashed_password=hashed_password)
+    except IntegrityError:
+        # 上面的检查与插入之间，可能有另一个请求抢先注册了相同的用户名或邮箱
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用户名或邮箱已被注册")
     return new_user
 
 @app.post("/auth/login", response_model=schemas.Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(security.get_db)):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(security.get_db)):
     # 1. 根据用户名从数据库查找用户
-    user = crud.get_user_by_username(db, username=form_data.username)
+    user = await crud.get_user_by_username(db, username=form_data.username)
+    user_id, username, password_hash = (user.id, user.username, user.password_hash) if user else (None, None, None)
+    
+    # 2. 在执行耗时的 Argon2 校验之前，先把连接归还给连接池
+    await db.close()
     
-    # 2. 验证用户是否存在，以及密码是否正确
-    if not user or not security.verify_password(form_data.password, user.password_hash):
+    # 3. 验证用户是否存在，以及密码是否正确
+    if username is None or not await run_in_threadpool(security.verify_password, form_data.password, password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="不正确的用户名或密码",
             headers={"WWW-Authenticate": "Bearer"},
         )
         
-    # 3. 如果验证成功，为该用户创建一个access token
+    # 4. 如果验证成功，为该用户创建一个access token
+    #    uid 让只需要用户ID的接口无需再查询数据库
     access_token = security.create_access_token(
-        data={"sub": user.username}
+        data={"sub": username, "uid": user_id}
     )
     
-    # 4. 返回token
+    # 5. 返回token
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 # --- 用户路由 (受保护) ---
 
 @app.get("/users/me", response_model=schemas.UserOut)
-def read_users_me(current_user: models.User = Depends(security.get_current_user)):
+async def read_users_me(current_user: schemas.UserOut = Depends(security.get_current_user)):
     """
     获取当前登录用户的信息。
     这个接口受OAuth2保护，请求时需要在Authorization header中提供Bearer Token。
     """
     return current_user
 
-@app.post("/diagrams", response_model=schemas.Diagram, status_code=status.HTTP_201_CREATED)
-def create_diagram(
+
+# --- 流程图路由 (受保护) ---
+# 这些路由返回的都是刚从我们自己数据库读出/写入的数据，无需再经过 Pydantic 逐字段校验：
+# 设置 response_model=None 并用 model_construct 直接构造响应模型 (跳过校验)，
+# 同时通过 responses 参数保留 /docs 中的响应结构说明。
+
+@app.post(
+    "/diagrams",
+    response_model=None,
+    status_code=status.HTTP_201_CREATED,
+    responses={status.HTTP_201_CREATED: {"model": schemas.Diagram}},
+)
+async def create_diagram(
     diagram: schemas.DiagramCreate, 
-    db: Session = Depends(security.get_db), 
-    current_user: models.User = Depends(security.get_current_user)
+    db: AsyncSession = Depends(security.get_db), 
+    current_user_id: int = Depends(security.get_current_user_id)
 ):
     """
     为当前登录用户创建一个新的流程图。
@@ -158,88 +241,99 @@ def create_diagram(
     - **title**: 流程图的标题。
     - **content**: (可选) 流程图的初始JSON内容。
     """
-    return crud.create_user_diagram(db=db, diagram=diagram, user_id=current_user.id)
+    created = await crud.create_user_diagram(db=db, diagram=diagram, user_id=current_user_id)
+    return schemas.Diagram.model_construct(**created)
 
-@app.get("/diagrams", response_model=list[schemas.Diagram])
-def read_diagrams(
+@app.get("/diagrams", response_model=None, responses={status.HTTP_200_OK: {"model": schemas.DiagramPage}})
+async def read_diagrams(
     skip: int = 0, 
     limit: int = 100, 
-    db: Session = Depends(security.get_db),
-    current_user: models.User = Depends(security.get_current_user)
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(security.get_db),
+    current_user_id: int = Depends(security.get_current_user_id)
 ):
     """
     获取当前登录用户的所有流程图列表。
-    支持分页查询。
+    列表只返回摘要信息 (不含 content)，完整内容请调用 GET /diagrams/{diagram_id}。
+    
+    - **after_id**: (推荐) 键集分页，传入上一页响应中的 `next_after_id` 获取下一页。
+    - **skip**: 偏移分页，仅在未提供 after_id 时生效。
+    - **limit**: 每页数量。
     """
-    diagrams = crud.get_user_diagrams(db, user_id=current_user.id, skip=skip, limit=limit)
-    return diagrams
+    diagrams = await crud.get_user_diagrams(db, user_id=current_user_id, skip=skip, limit=limit, after_id=after_id)
+    # 只有取满一整页时才可能还有下一页
+    next_after_id = diagrams[-1].id if diagrams and len(diagrams) == limit else None
+    return schemas.DiagramPage.model_construct(
+        items=[schemas.DiagramSummary.model_construct(**row._mapping) for row in diagrams],
+        next_after_id=next_after_id,
+    )
 
-@app.get("/diagrams/{diagram_id}", response_model=schemas.Diagram)
-def read_diagram(
+@app.get("/diagrams/{diagram_id}", response_model=None, responses={status.HTTP_200_OK: {"model": schemas.Diagram}})
+async def read_diagram(
     diagram_id: int,
-    db: Session = Depends(security.get_db),
-    current_user: models.User = Depends(security.get_current_user)
+    db: AsyncSession = Depends(security.get_db),
+    current_user_id: int = Depends(security.get_current_user_id)
 ):
     """
     获取单个流程图的详细信息。
     只能获取属于当前登录用户的流程图。
     """
-    # 1. 从数据库获取图
-    db_diagram = crud.get_diagram(db, diagram_id=diagram_id)
+    # 1. ‼️ 关键：只查询属于当前用户的图，所有权校验直接在SQL中完成
+    db_diagram = await crud.get_owned_diagram(db, diagram_id=diagram_id, user_id=current_user_id)
     
-    # 2. 检查图是否存在
+    # 2. 图不存在或不属于当前用户时，统一返回404，避免泄露其他用户的图是否存在
     if db_diagram is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="流程图未找到")
         
-    # 3. ‼️ 关键：检查图的所有者是否是当前用户
-    if db_diagram.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="无权访问此资源")
-        
-    # 4. 如果所有检查都通过，返回图的信息
-    return db_diagram
+    # 3. 如果所有检查都通过，返回图的信息
+    return schemas.Diagram.model_construct(
+        id=db_diagram.id,
+        title=db_diagram.title,
+        content=db_diagram.content,
+        user_id=db_diagram.user_id,
+        created_at=db_diagram.created_at,
+        updated_at=db_diagram.updated_at,
+    )
 
-@app.put("/diagrams/{diagram_id}", response_model=schemas.Diagram)
-def update_diagram_route(
+@app.put("/diagrams/{diagram_id}", response_model=None, responses={status.HTTP_200_OK: {"model": schemas.Diagram}})
+async def update_diagram_route(
     diagram_id: int,
     diagram_update: schemas.DiagramUpdate,
-    db: Session = Depends(security.get_db),
-    current_user: models.User = Depends(security.get_current_user)
+    db: AsyncSession = Depends(security.get_db),
+    current_user_id: int = Depends(security.get_current_user_id)
 ):
     """
     更新指定的流程图。
     只能更新属于当前登录用户的流程图。
     """
     # 1. 复用权限校验逻辑
-    db_diagram = crud.get_diagram(db, diagram_id=diagram_id)
+    db_diagram = await crud.get_owned_diagram(db, diagram_id=diagram_id, user_id=current_user_id)
     if db_diagram is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="流程图未找到")
-    if db_diagram.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="无权访问此资源")
         
     # 2. 调用CRUD函数执行更新
-    return crud.update_diagram(db=db, db_diagram=db_diagram, diagram_update=diagram_update)
+    updated = await crud.update_diagram(db=db, db_diagram=db_diagram, diagram_update=diagram_update)
+    return schemas.Diagram.model_construct(**updated)
 
 
 @app.delete("/diagrams/{diagram_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_diagram_route(
+async def delete_diagram_route(
     diagram_id: int,
-    db: Session = Depends(security.get_db),
-    current_user: models.User = Depends(security.get_current_user)
+    db: AsyncSession = Depends(security.get_db),
+    current_user_id: int = Depends(security.get_current_user_id)
 ):
     """
     删除指定的流程图。
     只能删除属于当前登录用户的流程图。
     """
     # 1. 再次复用权限校验逻辑
-    db_diagram = crud.get_diagram(db, diagram_id=diagram_id)
+    db_diagram = await crud.get_owned_diagram(db, diagram_id=diagram_id, user_id=current_user_id)
     if db_diagram is None:
         # 即使图不存在，对于DELETE操作，返回404也是合适的
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="流程图未找到")
-    if db_diagram.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="无权访问此资源")
         
     # 2. 调用CRUD函数执行删除
-    crud.delete_diagram(db=db, db_diagram=db_diagram)
+    await crud.delete_diagram(db=db, db_diagram=db_diagram)
     
     # 3. 对于 204 状态码，FastAPI 不会发送任何响应体
     return None
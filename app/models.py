@@ -1,8 +1,20 @@
 # 现在，我们要把之前设计的 users 和 diagrams 表，用Python代码的形式“画”出来。这些类就是所谓的ORM模型。
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, JSON, text # <-- Import 'text'
+from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, JSON, Index, text # <-- Import 'text'
 from sqlalchemy.orm import relationship
+from datetime import datetime, timezone
 from .database import Base
 
+
+def utc_now() -> datetime:
+    """
+    在 Python 端生成时间戳。
+    插入时由 SQLAlchemy 直接填入，这样提交后无需 refresh 就能拿到 created_at/updated_at。
+    返回值与数据库中实际存储、读出的值完全一致：
+    - 数据库连接的会话时区固定为 UTC (见 database.py)，读出的 TIMESTAMP 是不带时区的 UTC 时间；
+    - TIMESTAMP 列只精确到秒，所以这里也去掉微秒。
+    """
+    return datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -11,16 +23,21 @@ class User(Base):
     email = Column(String(100), unique=True, index=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
     # --- CHANGE HERE ---
-    created_at = Column(TIMESTAMP, nullable=False, server_default=text('CURRENT_TIMESTAMP'))
+    created_at = Column(TIMESTAMP, nullable=False, default=utc_now, server_default=text('CURRENT_TIMESTAMP'))
 
     # 'diagrams'是给User模型添加的一个属性，方便地访问该用户所有的流程图
     # back_populates="owner" 表示这个关系与Diagram模型中的'owner'属性是相互关联的
+    # 注意：关系默认是懒加载的，列表类查询请在 crud 中显式指定加载策略 (raiseload / selectinload)，
+    # 调试 N+1 问题时可以临时把这里改为 lazy="raise"，让所有隐式懒加载直接报错。
     diagrams = relationship("Diagram", back_populates="owner")
 
 
 class Diagram(Base):
     # __tablename__ 精确指定了这个类对应数据库里的表名。
     __tablename__ = "diagrams"
+    # 复合索引 (user_id, id)：按用户列出流程图、分页以及所有权校验都可以走索引范围扫描。
+    # 它的前缀同时满足 user_id 外键对索引的要求，所以无需再单独给 user_id 建索引。
+    __table_args__ = (Index("ix_diagrams_user_id_id", "user_id", "id"),)
 
     # Column(...) 定义了表里的每一个字段，包括它的数据类型、是否是主键等约束。
     id = Column(Integer, primary_key=True, index=True)
@@ -29,10 +46,11 @@ class Diagram(Base):
     share_uuid = Column(String(36), unique=True, index=True, nullable=True)
     
     # --- AND CHANGE HERE ---
-    created_at = Column(TIMESTAMP, nullable=False, server_default=text('CURRENT_TIMESTAMP'))
-    updated_at = Column(TIMESTAMP, nullable=False, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
+    # default=utc_now 在 Python 端生成时间；server_default 仍保留在表结构中，供直接写 SQL 时使用
+    created_at = Column(TIMESTAMP, nullable=False, default=utc_now, server_default=text('CURRENT_TIMESTAMP'))
+    updated_at = Column(TIMESTAMP, nullable=False, default=utc_now, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
     
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     # 'owner'是给Diagram模型添加的一个属性，方便地访问这张图的创建者(User)
     # back_populates="diagrams" 表示这个关系与User模型中的'diagrams'属性是相互关联的
     # relationship(...) 是ORM的精髓，它在代码层面建立了 User 和 Diagram 之间的关联，让我们可以方便地通过 user.diagrams 来获取一个用户的所有图，或者通过 diagram.owner 获取图的作者。
@@ -55,6 +55,22 @@ class Diagram(DiagramBase):
     class Config:
         from_attributes = True # 之前叫 orm_mode
 
+# 用于流程图列表的Schema (输出)，只包含摘要字段，不返回 content
+class DiagramSummary(BaseModel):
+    id: int
+    title: str
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+
+    class Config:
+        from_attributes = True
+
+# 流程图列表的分页响应
+# next_after_id: 下一页请求时传给 after_id 的值；为 None 表示已经没有更多数据
+class DiagramPage(BaseModel):
+    items: list[DiagramSummary]
+    next_after_id: Optional[int] = None
+
 # 这个模型用于更新操作，所有字段都应该是可选的
 class DiagramUpdate(BaseModel):
     title: Optional[str] = None
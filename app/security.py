@@ -1,26 +1,51 @@
-from passlib.context import CryptContext
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
+import os
+import time
+from functools import lru_cache
+from typing import Optional
 from datetime import datetime, timedelta, timezone
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from jose import JWTError, jwt
+from sqlalchemy.ext.asyncio import AsyncSession
+import jwt  # PyJWT，HMAC 签名通过 hashlib/OpenSSL 计算
 
 # 引入我们项目中的其他模块
 from . import schemas, crud  # crud在这里是隐式使用的，通过main.py调用
 from .database import SessionLocal # 直接从database导入SessionLocal，用于get_db
 
-# 1. 修改 CryptContext，将 argon2 作为首选方案
-#    我们保留 bcrypt 是为了未来的兼容性，但默认不会使用它。
-pwd_context = CryptContext(schemes=["argon2", "bcrypt"], deprecated="auto")
+# 1. 直接使用 argon2-cffi 的 PasswordHasher (C 实现)，不再经过 passlib 的封装
+#    默认参数采用 OWASP 推荐值: t=3, m=46MiB, p=1
+#    可通过环境变量覆盖，请先在生产机器上运行 scripts/calibrate_argon2.py 得到合适的值
+#    ARGON2_M_COST 的单位是 KiB
+ARGON2_T_COST = int(os.getenv("ARGON2_T_COST", "3"))
+ARGON2_M_COST = int(os.getenv("ARGON2_M_COST", str(46 * 1024)))
+ARGON2_P_COST = int(os.getenv("ARGON2_P_COST", "1"))
 
-# 2. 验证密码的函数 (这个函数不需要任何改动)
+ph = PasswordHasher(
+    time_cost=ARGON2_T_COST,
+    memory_cost=ARGON2_M_COST,
+    parallelism=ARGON2_P_COST,
+    hash_len=32,
+    salt_len=16,
+)
+
+# 2. 验证密码的函数
+#    注意：这是 CPU/内存密集型操作，在 async 路由中请通过 run_in_threadpool 调用
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return ph.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
-# 3. 哈希密码的函数 (这个函数也不需要任何改动)
+# 3. 哈希密码的函数 (同样请在线程池中调用)
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return ph.hash(password)
+
+# 4. 判断旧哈希是否需要按当前参数重新计算 (用于参数调整后的渐进式升级)
+def password_needs_rehash(hashed_password: str) -> bool:
+    return ph.check_needs_rehash(hashed_password)
 
 # --- JWT Configuration ---
 # !! 替换成你自己生成的密钥 !!
@@ -40,50 +65,131 @@ def create_access_token(data: dict):
 
 
 # --- FastAPI Dependency: OAuth2PasswordBearer ---
+# 每个受保护的请求都要经过这里，所以我们继承 OAuth2PasswordBearer 并重写 __call__：
+# - 继承父类是为了继续向 OpenAPI 注册安全方案，/docs 的 Authorize 按钮依赖它；
+# - 重写 __call__ 则直接切片解析 Authorization 头，跳过父类的通用解析逻辑。
+class _BearerTokenScheme(OAuth2PasswordBearer):
+    async def __call__(self, request: Request) -> str:
+        authorization = request.headers.get("authorization")
+        # 与父类一致：Bearer 前缀不区分大小写
+        if not authorization or authorization[:7].lower() != "bearer ":
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authenticated",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return authorization[7:]
+
+
 # 这个对象会告诉FastAPI去哪里寻找Token。
 # tokenUrl="auth/login" 指明了获取token的端点是 /auth/login。
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+# scheme_name 必须保持为 "OAuth2PasswordBearer"：OpenAPI 中安全方案默认以类名命名，
+# 而 main.py 的 custom_openapi 是按这个名字覆盖成 Bearer Token 方案的 (/docs 中粘贴 token 的输入框依赖它)。
+oauth2_scheme = _BearerTokenScheme(tokenUrl="auth/login", scheme_name="OAuth2PasswordBearer")
 
 
 # --- FastAPI Dependency: get_db ---
 # 我们把get_db也放在这里，或者保持在main.py，但为了让get_current_user能直接用，这里也需要能访问到它
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-# --- Core Dependency: Token Verification and User Retrieval ---
-# 这是我们的“门禁守卫”
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# --- Token / User 缓存 ---
+# 同一个客户端会反复携带同一个 token 请求，每次都做 JWT 校验 + 查询用户是不必要的开销：
+# 1. _decode 用 LRU 缓存 token 的解码结果 (解码失败会抛异常，不会被缓存)
+# 2. _user_cache 按用户名缓存用户信息快照 (schemas.UserOut，不含密码哈希)，有效期 USER_CACHE_TTL_SECONDS 秒
+# ‼️ 注意：用户登出、修改密码、被删除时，必须调用 invalidate_user_cache，否则在缓存有效期内旧数据仍会生效。
+USER_CACHE_TTL_SECONDS = 30
+USER_CACHE_MAXSIZE = 4096
+_user_cache: dict[str, tuple[float, schemas.UserOut]] = {}
+
+@lru_cache(maxsize=4096)
+def _decode(token: str) -> tuple[str, Optional[int], float]:
+    """
+    校验并解码JWT，返回 (用户名, 用户ID, 过期时间戳)。
+    旧版本签发的 token 不含 uid，此时用户ID为 None。
+    结果会被缓存，因此调用方每次都要自己检查过期时间。
+    """
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username = payload.get("sub")
+    user_id = payload.get("uid")
+    expire = payload.get("exp")
+    if username is None or expire is None:
+        raise jwt.InvalidTokenError("token 缺少 sub 或 exp")
+    return username, user_id, float(expire)
+
+def invalidate_user_cache(username: Optional[str] = None):
+    """
+    清除某个用户的缓存；不传用户名时清空全部缓存。
+    """
+    if username is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(username, None)
+
+
+# --- Core Dependency: Token Verification ---
+# 轻量版的“门禁守卫”：只校验JWT并返回其中的用户ID，不访问数据库。
+# 只需要知道“当前用户是谁”的路由 (例如流程图相关接口) 应该使用这个依赖。
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> int:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="无法验证凭据 (Could not validate credentials)",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        # 1. 解码JWT
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username, user_id, expire = _decode(token)
+    except jwt.PyJWTError:
+        raise credentials_exception
         
-        # 2. 从payload中获取用户名
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-            
-        # 3. 将用户名包装在Pydantic模型中
-        token_data = schemas.TokenData(username=username)
-    except JWTError:
+    # 不含 uid 的旧 token 需要重新登录
+    if user_id is None or expire <= time.time():
+        raise credentials_exception
+    return user_id
+
+
+# --- Core Dependency: Token Verification and User Retrieval ---
+# 这是我们的“门禁守卫”，需要完整用户信息时 (如 /users/me) 使用
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="无法验证凭据 (Could not validate credentials)",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        # 1. 解码JWT并获取用户名 (命中缓存时不再重复校验签名)
+        username, _, expire = _decode(token)
+    except jwt.PyJWTError:
         # 如果解码失败 (如token格式错误、过期等)，抛出异常
         raise credentials_exception
         
-    # 4. 使用用户名从数据库中获取用户
+    # 2. 缓存的解码结果不会自动过期，这里需要再检查一次
+    if expire <= time.time():
+        raise credentials_exception
+        
+    # 3. 先查缓存，命中且未过期时直接返回，省去一次数据库查询
+    cached = _user_cache.get(username)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+        
+    # 4. 将用户名包装在Pydantic模型中
+    token_data = schemas.TokenData(username=username)
+        
+    # 5. 使用用户名从数据库中获取用户
     # 注意：这里我们直接调用crud.py里的函数
-    user = crud.get_user_by_username(db, username=token_data.username)
+    user = await crud.get_user_by_username(db, username=token_data.username)
     if user is None:
         # 如果在数据库中找不到该用户 (例如用户被删除)，也抛出异常
         raise credentials_exception
         
-    # 5. 返回完整的User对象
-    return user
+    # 6. 只保留对外可见的字段，不把 ORM 对象 (含 password_hash) 留在进程内存里跨请求共享
+    current_user = schemas.UserOut.model_validate(user)
+        
+    # 7. 写入缓存 (超出容量时简单地整体清空)
+    if len(_user_cache) >= USER_CACHE_MAXSIZE:
+        _user_cache.clear()
+    _user_cache[username] = (time.monotonic() + USER_CACHE_TTL_SECONDS, current_user)
+        
+    # 8. 返回用户信息快照
+    return current_user
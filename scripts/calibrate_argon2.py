@@ -0,0 +1,64 @@
+# Argon2 参数校准脚本
+# 在生产服务器上运行，找出在 p95 延迟预算内可以使用的最大 memory_cost。
+# 用法: python scripts/calibrate_argon2.py [--budget-ms 300] [--time-cost 3] [--parallelism 1]
+# 得到结果后，将输出的环境变量配置到服务的运行环境中。
+import argparse
+import statistics
+import time
+
+from argon2 import PasswordHasher
+
+
+def measure_p95(ph: PasswordHasher, rounds: int) -> float:
+    """
+    对给定参数的 PasswordHasher 计时，返回 p95 耗时 (毫秒)。
+    """
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        ph.hash("x")
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.quantiles(samples, n=20)[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="校准 Argon2 的 memory_cost 参数")
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="单次哈希允许的 p95 耗时 (毫秒)")
+    parser.add_argument("--time-cost", type=int, default=3)
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=20, help="每组参数的测量次数")
+    parser.add_argument("--min-mib", type=int, default=19, help="memory_cost 的下限 (MiB)，OWASP 最低建议为 19MiB")
+    parser.add_argument("--max-mib", type=int, default=256, help="memory_cost 的上限 (MiB)")
+    args = parser.parse_args()
+
+    best_mib = None
+    mib = args.min_mib
+    # 从下限开始逐步增加内存，直到 p95 超出预算
+    while mib <= args.max_mib:
+        ph = PasswordHasher(
+            time_cost=args.time_cost,
+            memory_cost=mib * 1024,
+            parallelism=args.parallelism,
+            hash_len=32,
+            salt_len=16,
+        )
+        p95 = measure_p95(ph, args.rounds)
+        print(f"m={mib}MiB t={args.time_cost} p={args.parallelism} -> p95={p95:.1f}ms")
+        if p95 > args.budget_ms:
+            break
+        best_mib = mib
+        mib += 1 if mib < 32 else 8
+
+    if best_mib is None:
+        print(f"即使 m={args.min_mib}MiB 也超出了 {args.budget_ms}ms 的预算，请降低 --time-cost 或提高预算。")
+        return
+
+    print()
+    print("# 推荐配置:")
+    print(f"ARGON2_M_COST={best_mib * 1024}")
+    print(f"ARGON2_T_COST={args.time_cost}")
+    print(f"ARGON2_P_COST={args.parallelism}")
+
+
+if __name__ == "__main__":
+    main()